@@ -1,13 +1,45 @@
 #!/usr/bin/env python3.7
 
 import argparse, sys, os
+import gzip
 import logging
+import re
+import shlex
 import shutil
+import stat
 import subprocess
-import pandas as pd
-from io import StringIO
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from tabulate import tabulate
+
+## version of the running python, e.g. 3.7.12
+PY_VER = '.'.join(map(str, sys.version_info[:3]))
+
+## read 1 suffixes stripped to get the sample name
+FASTQ_NAME_RE = re.compile(r'(?:_1|_R1_001|_R1)\.f(?:ast)?q(?:\.gz)?$')
+
+## genome size and coverage estimates that mash dist -r writes to stderr
+MASH_STDERR_RE = re.compile(r'Estimated (genome size|coverage):\s*(\S+)')
+
+## kmer size line of the mash info header
+MASH_KSIZE_RE = re.compile(r'^\s*K-mer size:\s*(\S+)', re.MULTILINE)
+
+## reference names are Genus_species_GCA# (or GCF#); groups are genus, species
+## and the GeneBank identifier, the last two are empty when a name lacks them
+REF_ID_RE = re.compile(r'^([^_]+)(?:_([^_]+))?(?:_.*?(GC[AF]\S*)?)?$')
+
+## columns of the tab separated mash dist output and the ones that are kept
+MASH_COLUMNS = ['Ref ID', 'Query ID', 'Mash Dist', 'P-value', 'Kmer']
+MASH_USECOLS = ['Ref ID', 'Mash Dist', 'P-value', 'Kmer']
+MASH_DTYPES = {'Ref ID': str, 'Mash Dist': 'float32', 'P-value': 'float64',
+'Kmer': str}
+
+## columns, header and row layout of the top 5 hits table in the results file
+REPORT_COLUMNS = ['Genus', 'Species', 'GeneBank Identifier', 'Mash Dist',
+'% Seq Sim', 'P-value', 'Kmer']
+REPORT_HEADER_FMT = "{:^16} {:^16} {:^24} {:^10} {:^10} {:^16} {:^10}"
+REPORT_ROW_FMT = "{:^16} {:^16} {:^24} {:>10.5f} {:>10.3f} {:>16.8e} {:>10}"
 
 #############################
 ## Argument Error Messages ##
@@ -21,51 +53,66 @@ class ParserWithErrors(argparse.ArgumentParser):
         self.print_help()
         sys.exit(2)
 
-    def is_valid_mash(self, parser, arg):
-        base, ext = os.path.splitext(arg)
-        if ext not in ('.msh') or ext in ('') :
-            parser.error('This is not a file ending with .msh.\
- Did you generate the mash sketch and specified that file to be uploaded?')
-        else:
-            return arg
+#########################
+## Argument Validators ##
+#########################
 
-    def is_valid_fastq(self, parser, arg):
-        base, ext = os.path.splitext(arg)
-        if ext not in ('.gz', '.fastq', '.fastq.gz'):
-            parser.error('This is not a file ending with either .fastq or \
-.fastq.gz. This flag requires the input of a fastq file.')
-        else:
-            return arg
+## each returns the validated argument; argparse reports the
+## ArgumentTypeError message through ParserWithErrors.error
+def is_valid_mash(arg):
+    if not arg.endswith('.msh'):
+        raise argparse.ArgumentTypeError('This is not a file ending with .msh.\
+ Did you generate the mash sketch and specified that file to be uploaded?')
+    return arg
 
-    def is_valid_distance(self, parser, arg):
-        isFloat = True
-        try:
-            float(arg)
-        except ValueError:
-            isFloat = False
-        if (isFloat == False) or (float(arg) < 0) :
-            parser.error('%s is not a positive number (e.g., a float, aka a \
- number with a decimal point)' % arg)
-        else:
-            return arg
+def is_valid_fastq(arg):
+    if not arg.endswith(('.fastq', '.fastq.gz', '.fq', '.fq.gz')):
+        raise argparse.ArgumentTypeError('This is not a file ending with \
+.fastq, .fastq.gz, .fq or .fq.gz. This flag requires the input of a fastq \
+file.')
+    return arg
 
-    def is_valid_int(self, parser, arg):
-        isInt = True
-        try:
-            int(arg)
-        except ValueError:
-            isInt = False
-        if isInt == False:
-            parser.error("You input %s. This is NOT an integer." % arg)
-        elif arg.isnumeric() == False:
-            parser.error("You input %s. This is NOT a positive number." % arg)
-        else:
-            return arg
+def is_valid_distance(arg):
+    try:
+        isPositive = float(arg) >= 0
+    except ValueError:
+        isPositive = False
+    if not isPositive:
+        raise argparse.ArgumentTypeError('%s is not a positive number (e.g., \
+a float, aka a number with a decimal point)' % arg)
+    return float(arg)
+
+def is_valid_int(arg):
+    if not arg.isdigit():
+        raise argparse.ArgumentTypeError("You input %s. This is NOT a \
+positive integer." % arg)
+    return int(arg)
 
 #########################
 ## ArgParser Arguments ##
 #########################
 
+def default_threads():
+    """
+    Returns the number of CPUs available to this process; uses the slurm
+    allocation when set
+
+    Returns
+    -------
+    str
+        Number of threads to pass to mash
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        nCpus = len(os.sched_getaffinity(0))
+    else:
+        nCpus = os.cpu_count() or 2
+    ## ignore an empty or invalid slurm value instead of failing on a -p
+    ## flag the user never passed
+    slurmCpus = os.environ.get('SLURM_CPUS_PER_TASK', '')
+    if slurmCpus.isdigit() and int(slurmCpus) > 0:
+        return slurmCpus
+    return str(nCpus)
+
 def argparser():
     """
     Returns an argument parser for this script
@@ -84,22 +131,29 @@ def argparser():
 
     required.add_argument("--database", "-b", required=True,
                         help="Pre-built Mash Sketch",
-                        type=lambda x: parser.is_valid_mash(parser, x))
+                        type=is_valid_mash)
     required.add_argument("--read1", "-r1", required=True,
                         help="Input Read 1 (forward) file",
-                        type=lambda x: parser.is_valid_fastq(parser, x))
+                        type=is_valid_fastq)
     required.add_argument("--read2", "-r2", required=True,
                         help="Input Read 2 (reverse) file",
-                        type=lambda x: parser.is_valid_fastq(parser, x))
+                        type=is_valid_fastq)
     optional.add_argument("--max_dist", "-d", default=0.05,
                         help="User specified mash distance (default: 0.05)",
-                        type=lambda x: parser.is_valid_distance(parser, x))
+                        type=is_valid_distance)
     optional.add_argument("--kmer_min", "-m", default=2,
                         help="Minimum copies of kmer count (default: 2)",
-                        type=lambda x: parser.is_valid_int(parser, x))
-    optional.add_argument("--num_threads", "-p", default=2,
-                        help="Number of computing threads to use (default: 2)",
-                        type=lambda x: parser.is_valid_int(parser, x))
+                        type=is_valid_int)
+    optional.add_argument("--num_threads", "-p", default=default_threads(),
+                        help="Number of computing threads to use (default: \
+available CPUs)",
+                        type=is_valid_int)
+    optional.add_argument("--dedup", action="store_true",
+                        help="Remove duplicate reads before running mash; \
+kmer copies are then not filtered (-m 1)")
+    optional.add_argument("--db_info", default=None,
+                        help="Saved output of mash info for the database; \
+the kmer size is read from it instead of running mash info")
     return parser
 
 ###############
@@ -118,15 +172,13 @@ def fastq_name(inRead1):
     xxx
         xxx
     """
-    if inRead1.endswith("_1.fastq"):
-        name = inRead1.split("_1.fastq")[0]
-        return(name)
-    elif inRead1.endswith("_R1_001.fastq"):
-        name = inRead1.split("_R1_001.fastq")[0]
+    match = FASTQ_NAME_RE.search(inRead1)
+    if match:
+        name = inRead1[:match.start()]
         return(name)
     else:
         logging.critical("Please check your file endings, assumes either \
-_1.fastq(.gz) or _R1_001.fastq(.gz)")
+_1.fastq(.gz), _R1.fastq(.gz) or _R1_001.fastq(.gz), or the same with .fq")
         sys.exit(1)
 
 def make_output_log(log):
@@ -143,13 +195,85 @@ def make_output_log(log):
     None
         Exits the program if unable to make output directory
     """
-    logging.basicConfig(filename=log, filemode="a", level=logging.DEBUG,
+    handler = logging.FileHandler(log, mode="a", encoding="utf-8")
+    logging.basicConfig(handlers=[handler], level=logging.DEBUG,
     format="%(asctime)s - %(message)s", datefmt="%m/%d/%Y %I:%M:%S %p")
-    logging.info("New log file created in output directory - %s... " % log)
+
+    ## batch runs can turn off the informational messages
+    if os.environ.get('MASHWRAPPER_QUIET') == '1':
+        logging.getLogger().setLevel(logging.WARNING)
+    logging.info("New log file created in output directory - %s... ", log)
     logging.info("Starting the tool...")
 
-inKSize = os.getenv('kSize')
-print("The kmer size is exported from database using mash info: %s" % inKSize)
+def get_k_size(inMash, mashStat, dbInfo=None):
+    """
+    Gets the kmer size used to build the mash database; it is read from saved
+    mash info output when given (the pipeline writes database.info anyway),
+    otherwise from a sidecar file (<database>.ksize) that caches it for
+    standalone runs so mash info only runs when the database is newer
+
+    Parameters
+    ----------
+    inMash : str
+        Mash database
+    mashStat : os.stat_result
+        stat of the mash database from check_files
+    dbInfo : str, optional, default is None
+        File with the output of mash info for the database
+
+    Returns
+    -------
+    str
+        kmer size of the mash database
+    """
+    if dbInfo is not None:
+        try:
+            with open(dbInfo) as f:
+                match = MASH_KSIZE_RE.search(f.read())
+        except OSError:
+            match = None
+        if match:
+            return match.group(1)
+        logging.info("No kmer size found in %s, running mash info...", dbInfo)
+
+    sidecar = inMash + '.ksize'
+    try:
+        if os.stat(sidecar).st_mtime >= mashStat.st_mtime:
+            with open(sidecar) as f:
+                kSize = f.read().strip()
+            if kSize:
+                return kSize
+    except FileNotFoundError:
+        pass
+
+    ## third field of the third line of mash info is the kmer size; only the
+    ## header is requested and mash is stopped once that line is read
+    infoCmd = ['mash', 'info', '-H', inMash]
+    proc = subprocess.Popen(infoCmd, stdout=subprocess.PIPE,
+    stderr=subprocess.DEVNULL)
+    kSize = None
+    for lineNum, line in enumerate(proc.stdout):
+        if lineNum == 2:
+            fields = line.split()
+            if len(fields) >= 3:
+                kSize = fields[2].decode('ascii')
+            break
+    proc.stdout.close()
+    if proc.poll() is None:
+        proc.terminate()
+    proc.wait()
+
+    if kSize is None:
+        logging.critical("CRITICAL ERROR. Unable to get the kmer size from \
+the following command: \n %s .", ' '.join(infoCmd))
+        sys.exit(1)
+    try:
+        with open(sidecar, 'w') as f:
+            f.write(kSize + "\n")
+        logging.info("Saved the kmer size of the database to %s...", sidecar)
+    except OSError:
+        pass
+    return kSize
 
 def get_input(inRead1, inRead2, inMash, inMaxDis, inKmer, inKSize, inThreads):
     """
@@ -163,11 +287,11 @@ def get_input(inRead1, inRead2, inMash, inMaxDis, inKmer, inKSize, inThreads):
         XXX
     inMash : str
         XXX
-    inMaxDis : str
+    inMaxDis : float
         XXX
-    inKmer : str
+    inKmer : int
         XXX
-    inThreads : str
+    inThreads : int
         XXX
 
     Returns
@@ -183,8 +307,30 @@ def get_input(inRead1, inRead2, inMash, inMaxDis, inKmer, inKSize, inThreads):
  * Maximum Distance: %s \n \
  * Minimum Kmer Count: %s \n \
  * Size of Kmer: %s \n \
- * Number of Threads: %s \n " %
- (inRead1, inRead2, inMash, inMaxDis, inKmer, inKSize, inThreads))
+ * Number of Threads: %s \n ",
+ inRead1, inRead2, inMash, inMaxDis, inKmer, inKSize, inThreads)
+
+def stat_file(path):
+    """
+    Stats a path once
+
+    Parameters
+    ----------
+    path : str
+        Path to check
+
+    Returns
+    -------
+    os.stat_result or None
+        None if the path doesn't exist or is not a regular file
+    """
+    try:
+        pathStat = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(pathStat.st_mode):
+        return None
+    return pathStat
 
 def check_files(inRead1, inRead2, inMash):
     """
@@ -193,35 +339,56 @@ def check_files(inRead1, inRead2, inMash):
 
     Parameters
     ----------
-    inRead1 : XX
-        XXX
-    inRead2 : XX
-        XXX
-    inMash : XX
-        XXX
+    inRead1 : str
+        Read 1 (forward) file
+    inRead2 : str
+        Read 2 (reverse) file
+    inMash : str
+        Mash database
     Returns
     -------
-    None
-        Exits the program if file doesn't exist
+    os.stat_result
+        stat of the mash database; exits the program if a file doesn't exist
     """
 
-    if inMash and not os.path.isfile(inMash):
-        logging.critical("The database - %s - doesn't exist. Exiting." % inMash)
-        sys.exit(1)
-    if inRead1 and not os.path.isfile(inRead1):
-        logging.critical("Read file 1: %s doesn't exist. Exiting." % inRead1)
-        sys.exit(1)
-    if inRead2 and not os.path.isfile(inRead2):
-        logging.critical("Read file 2: %s doesn't exist. Exiting." % inRead2)
+    ## stat every input once and report all the missing files together
+    inputs = (("The database", inMash), ("Read file 1", inRead1),
+    ("Read file 2", inRead2))
+    mashStat, read1Stat, read2Stat = stats = [stat_file(path) for _, path in inputs]
+    missing = [(label, path) for (label, path), pathStat in zip(inputs, stats)
+    if pathStat is None]
+    for label, path in missing:
+        logging.critical("%s - %s - doesn't exist.", label, path)
+    if missing:
+        logging.critical("Exiting.")
         sys.exit(1)
-    if inRead1 == inRead2:
-        logging.critical("Read1 - %s" % inRead1)
-        logging.critical("Read2 - %s" % inRead2)
+    ## same file even when given by two different paths (e.g. a symlink)
+    if os.path.samestat(read1Stat, read2Stat):
+        logging.critical("Read1 - %s", inRead1)
+        logging.critical("Read2 - %s", inRead2)
         logging.critical("Looks like you entered the same read file twice. \
  Exiting.")
         sys.exit(1)
+    return mashStat
 ##TO DO:  - do i want to check if the beginning of the file name is a match between the two files?
 
+def check_python():
+    """
+    Checks the version of the running python; no PATH lookup is needed since
+    this script is already running in it
+
+    Returns
+    -------
+    None
+        Exits the program if python is older than 3.7
+    """
+    if sys.version_info >= (3,7):
+        logging.info("The version of python is: %s...", PY_VER)
+    else:
+        logging.critical("You do not have an appropriate version of python. \
+ Requires Python version >= 3.7. Exiting.")
+        sys.exit(1)
+
 def check_program(program_name):
     """
     Checks if the supplied program_name exists
@@ -237,152 +404,298 @@ def check_program(program_name):
         Exits the program if a dependency doesn't exist
     """
     ##assumes that program name is lower case
-    logging.info("Checking for program %s..." % program_name)
+    logging.info("Checking for program %s...", program_name)
     path = shutil.which(program_name)
-    ver = sys.version_info[0:3]
-    ver  = ''.join(str(ver))
-    ver = ver.replace(",", ".")
-    ver = ver.replace('(','').replace(')','')
 
     if path != None:
-        if program_name == 'python' and sys.version_info >= (3,7):
-            logging.info("Great, the program %s is loaded ..." % program_name)
-            logging.info("The version of python is: %s..." % ver)
-        elif program_name != 'python':
-            logging.info("Great, the program %s is loaded..." % program_name)
-        else:
-            logging.info("You do not have an appropriate version of python. \
- Requires Python version >= 3.7. Exiting.")
-            sys.exit(1)
+        logging.info("Great, the program %s is loaded...", program_name)
     else:
         logging.critical("Program %s not found! Cannot continue; dependency\
- not fulfilled. Exiting." % program_name)
+ not fulfilled. Exiting.", program_name)
         sys.exit(1)
 
-def cat_files(inRead1, inRead2):
+def cat_reads(inRead1, inRead2, dedup=False):
     """
-    XXXX
+    Gets the source that feeds the two read files, one after the other, to
+    the stdin of mash so there is no concatenated copy on disk
 
     Parameters
     ----------
-    inRead1 : XX
-        XXX
-    inRead2 : XX
-        XXX
+    inRead1 : str
+        Read 1 (forward) file
+    inRead2 : str
+        Read 2 (reverse) file
+    dedup : bool, optional, default is False
+        Write only the unique read sequences, as fasta, instead of the reads
 
     Returns
     -------
-    None
-        XXX
+    subprocess.Popen or list
+        process whose stdout is the concatenated reads; without dedup, the
+        list of read files for send_reads instead when the reads are
+        uncompressed or neither pigz nor gzip is available
     """
-    if inRead1 and inRead2 != None and inRead1.endswith('.gz'):
-        logging.critical("The files are still gzipped. Exiting")
-        sys.exit(1)
+    ## gzipped reads are decompressed in the pipe; -f passes through any
+    ## file that is not gzipped
+    if inRead1.endswith('.gz') or inRead2.endswith('.gz'):
+        if shutil.which('pigz'):
+            readCmd = ['pigz', '-dcf', '-p', str(max(inThreads//2, 1))]
+        elif shutil.which('gzip'):
+            readCmd = ['gzip', '-dcf']
+        elif dedup:
+            ## the dedup pipeline runs in the shell and can't use gzip.open
+            logging.critical("Program pigz or gzip not found! Required to \
+decompress the reads with --dedup. Exiting.")
+            sys.exit(1)
+        else:
+            logging.info("Decompressing the gzipped files with python...")
+            return [inRead1, inRead2]
+        logging.info("Decompressing the gzipped files with %s...", readCmd[0])
+    elif not dedup:
+        return [inRead1, inRead2]
     else:
-        logging.info("The files have been gunzipped ...")
-        with open(inRead1) as readFile:
-            read1 = readFile.read()
-        with open(inRead2) as readFile:
-            read2 = readFile.read()
-            read1 += read2
-        with open('myCatFile', 'w') as readFile:
-            readFile.write(read1)
-            readFile.close()
+        readCmd = ['cat']
+    readCmd += [inRead1, inRead2]
+
+    if dedup:
+        logging.info("Removing duplicate reads...")
+        ## sequence is the second line of each fastq record
+        dedupCmd = ("%s | awk 'NR %% 4 == 2' | LC_ALL=C sort -u | "
+        "awk '{print \">\" NR; print}'" %
+        ' '.join(shlex.quote(arg) for arg in readCmd))
+        ## pipefail so a failed read or decompression is not hidden by awk
+        return subprocess.Popen(['bash', '-o', 'pipefail', '-c', dedupCmd],
+        stdout=subprocess.PIPE)
+    return subprocess.Popen(readCmd, stdout=subprocess.PIPE)
+
+def send_reads(readFiles, pipe, errors):
+    """
+    Copies the read files into the stdin pipe of mash and closes it; on linux
+    os.sendfile copies in the kernel without passing the data through python
+    and gzipped files are decompressed with gzip.open as they are copied
+
+    Parameters
+    ----------
+    readFiles : list
+        Read files to copy, in order
+    pipe : file object
+        stdin of the mash process
+    errors : list
+        Any error reading the files is appended here for the caller
+    """
+    try:
+        for readFile in readFiles:
+            if readFile.endswith('.gz'):
+                with gzip.open(readFile, 'rb') as inFile:
+                    shutil.copyfileobj(inFile, pipe, 1<<22)
+                continue
+            with open(readFile, 'rb') as inFile:
+                if sys.platform.startswith('linux'):
+                    ## sendfile writes to the fd directly, so anything still
+                    ## buffered from a gzipped file has to go out first
+                    pipe.flush()
+                    offset = 0
+                    size = os.fstat(inFile.fileno()).st_size
+                    while offset < size:
+                        sent = os.sendfile(pipe.fileno(), inFile.fileno(),
+                        offset, size - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+                else:
+                    shutil.copyfileobj(inFile, pipe, 1<<22)
+    ## mash stopped reading; its exit code is checked by the caller
+    except BrokenPipeError:
+        pass
+    ## a truncated or corrupt gzipped file raises EOFError or zlib.error
+    except (OSError, EOFError, zlib.error) as err:
+        errors.append(err)
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
 
-def minKmer(calculatedKmer, inKmer):
+def parse_mash_dist(stdout):
     """
-    Determine the value of the kmers (-m flag); if less than 2, set as 2
+    Parses the mash dist output line by line into a data frame while mash is
+    still writing
 
     Parameters
     ----------
-    calculatedKmer : int
-        Value that is calculated based on genomeCoverage/3
-    inKmer : int, optional, default is 2
-        Input kmer value specified by user; to be used instead of calucated
+    stdout : file object
+        stdout pipe of the mash dist process
 
     Returns
-    ----------
-    int
-        integer value used for min_kmer (-m flag) with paired-end reads
+    -------
+    pandas data frame
+        mash dist output, only the MASH_USECOLS columns and references with
+        at least one shared kmer
     """
-    if int(inKmer) == 2:
-        logging.info("Should kmer value be different than default (2)...")
-        logging.info("Min. kmer = genome coverage divided by 3..." )
-        #return calculatedKmer
-        if (calculatedKmer < 2 or int(inKmer) < 2):
-            logging.info("The calucated kmer is less than 2, so will use 2...")
-            calculatedKmer = 2
-        return calculatedKmer
-    elif (int(inKmer) > 2):
-        logging.info("User specified a value for minimum kmer: %s ..." % inKmer)
-        return int(inKmer)
-
-def run_cmd(command):
+    ## pandas is only imported once mash is run so --help and argument
+    ## errors exit without paying for it
+    import pandas as pd
+
+    ## split each tab separated line as mash writes it; the Query ID column
+    ## is the same on every line and is not kept, nor are references that
+    ## share no kmers with the reads (0/xxxx) as they can't be a match
+    refIds, dists, pValues, kmers = [], [], [], []
+    for line in stdout:
+        fields = line.decode('utf-8').rstrip('\n').split('\t')
+        if len(fields) != len(MASH_COLUMNS) or fields[4].startswith('0/'):
+            continue
+        refIds.append(fields[0])
+        dists.append(float(fields[2]))
+        pValues.append(float(fields[3]))
+        kmers.append(fields[4])
+    return pd.DataFrame(dict(zip(MASH_USECOLS, (refIds, dists, pValues, kmers))),
+    columns=MASH_USECOLS).astype(MASH_DTYPES)
+
+def run_mash_dist(command, reads, parse=True):
     """
-    XXXX
+    Runs mash dist and parses its stdout while mash is still writing; stderr
+    is collected on a separate thread so neither pipe can fill up and block
+    mash
 
     Parameters
     ----------
-    XX : XX
-        XXXcd
+    command : list
+        mash dist command to run, reading the query from stdin (-)
+    reads : subprocess.Popen or list
+        process or read files from cat_reads that feed the reads to mash
+    parse : bool, optional, default is True
+        Parse stdout with parse_mash_dist; when False stdout is only drained,
+        for runs where just the estimates on stderr are needed
 
     Returns
     -------
-    XXX : XXX
-        XXX
+    df : pandas data frame or None
+        output of parse_mash_dist; None when parse is False
+    stderr : str
+        stderr from mash dist
     """
+    if isinstance(reads, subprocess.Popen):
+        proc = subprocess.Popen(command, stdin=reads.stdout,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1<<20)
+        ## only mash should hold the read end of the pipe
+        reads.stdout.close()
+        feedThread = None
+    else:
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1<<20)
+        feedErrors = []
+        feedThread = threading.Thread(target=send_reads,
+        args=(reads, proc.stdin, feedErrors))
+        feedThread.start()
+    errChunks = []
+    errThread = threading.Thread(target=lambda: errChunks.append(proc.stderr.read()))
+    errThread.start()
+
+    if parse:
+        df = parse_mash_dist(proc.stdout)
+    else:
+        df = None
+        while proc.stdout.read(1<<20):
+            pass
+    errThread.join()
+    stderr = errChunks[0].decode('utf-8', errors='replace')
 
-    try:
-        result = subprocess.run(command, capture_output=True,\
-        check=True, text=True)
-        new_cmd=(' '.join(command))
-        logging.info("This is the command... \n %s " % new_cmd)
-    except subprocess.CalledProcessError:
+    if proc.wait() != 0:
         logging.critical("CRITICAL ERROR. The following command had an improper\
- error: \n %s ." % command)
+ error: \n %s .", ' '.join(command))
+        logging.critical(stderr)
         sys.exit(1)
-    return result
+    if feedThread is not None:
+        feedThread.join()
+        readFailed = bool(feedErrors)
+    else:
+        readFailed = reads.wait() != 0
+    if readFailed:
+        logging.critical("CRITICAL ERROR. Unable to read the fastq files %s \
+and %s.", inRead1, inRead2)
+        sys.exit(1)
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("This is the command... \n %s ", ' '.join(command))
+    return df, stderr
 
-def cal_kmer():
+def get_SC(stderr):
     """
-    XXXX
+    Gets the estimated genome size and coverage from the mash stderr
 
     Parameters
     ----------
-    XX : XX
-        XXX
+    stderr : str
+        stderr from running mash dist with the -r flag
 
     Returns
     -------
-    mFlag : tuple, position 0
-        XXX
+    gSize : str
+        Estimated genome size
+    gCoverage : str
+        Estimated genome coverage
+    """
+    fields = dict(MASH_STDERR_RE.findall(stderr))
+    if 'genome size' not in fields or 'coverage' not in fields:
+        logging.critical("Unable to find the estimated genome size and \
+coverage in the mash output. Exiting.")
+        sys.exit(1)
+    logging.info("Estimated Genome Size: %s ", fields['genome size'])
+    logging.info("Estimated Genome coverage: %s ", fields['coverage'])
+    return fields['genome size'], fields['coverage']
+
+def cal_kmer():
     """
+    Runs mash dist on the reads to estimate genome size and coverage, which
+    are used to calculate the minimum kmer copies (-m flag); not run with
+    --dedup, where -m is always 1
 
-    f = open('myCatFile', 'r')
-    fastqCmd1 = ['mash', 'dist', inMash, '-r', 'myCatFile', '-p', inThreads, '-S', '42']
+    Returns
+    -------
+    mFlag : tuple
+        minimum kmer copies, genome size and genome coverage
+    """
+
+    ## mash's default -m is kept here so the estimates include every kmer
+    fastqCmd1 = ['mash', 'dist', '-r', inMash, '-', '-p', str(inThreads), '-S', '42']
 
-    outputFastq1 = run_cmd(fastqCmd1)
+    ## only the estimates on stderr are used from this run
+    _, stderr = run_mash_dist(fastqCmd1, cat_reads(inRead1, inRead2, inDedup),
+    parse=False)
 
     ## get genome size and coverage; will provide as ouput for user
-    gSize = outputFastq1.stderr.splitlines()[0]
-    gSize = gSize[23:]
-    logging.info("Estimated Genome Size: %s " % gSize)
-    gCoverage = outputFastq1.stderr.splitlines()[1]
-    gCoverage = gCoverage[23:]
-    logging.info("Estimated Genome coverage: %s "% gCoverage)
-
-    minKmers = int(float(gCoverage))/3
-    minKmers = int(float(minKmers))
-
-    ## this is used the calucate the minimum kmer copies to use (-m flag)
-    mFlag = minKmer(minKmers, inKmer) # returned as an integer
+    gSize, gCoverage = get_SC(stderr)
+
+    ## minimum kmer copies to use (-m flag); a user value above the default
+    ## of 2 is used as is, otherwise genome coverage / 3 but at least 2
+    if inKmer > 2:
+        logging.info("User specified a value for minimum kmer: %s ...", inKmer)
+        mFlag = inKmer
+    else:
+        logging.info("Min. kmer = genome coverage divided by 3, at least 2...")
+        mFlag = max(2, int(float(gCoverage) / 3))
     return mFlag, gSize, gCoverage
 
 def get_results(mFlag, inThreads):
-    fastqCmd2 = ['mash', 'dist', '-r', '-m', str(mFlag), inMash, 'myCatFile', '-p', inThreads, '-S', '123456']
-    outputFastq2 = run_cmd(fastqCmd2)
-    #os.remove('myCatFile')
-    return outputFastq2
+    """
+    Runs mash dist with the calculated -m flag
+
+    Parameters
+    ----------
+    mFlag : int
+        minimum kmer copies (-m flag)
+    inThreads : int
+        number of threads for mash
+
+    Returns
+    -------
+    outputFastq2 : pandas data frame
+        parsed output of mash dist with the -m flag
+    stderr : str
+        stderr from mash dist, which holds the genome size and coverage
+    """
+    fastqCmd2 = ['mash', 'dist', '-r', '-m', str(mFlag), inMash, '-', '-p', str(inThreads), '-S', '123456']
+    outputFastq2, stderr = run_mash_dist(fastqCmd2, cat_reads(inRead1, inRead2, inDedup))
+    return outputFastq2, stderr
 
 def isTie(df):
     """
@@ -401,23 +714,22 @@ def isTie(df):
         string of best species either species or a blank string
 
     """
-    dfSort = df.sort_values('KmersCount', ascending=False)
+    ## only the top two rows are needed for the tie check
+    dfSort = df.nlargest(2, 'KmersCount')
     logging.info("Checking if matching kmers count is tied for top 2 results...")
 
-    ## assumes based on position the first and second value are always
-    ## column 11; row 1 and 2
-    if dfSort.iloc[0:1, 10:11].equals(dfSort.iloc[1:2, 10:11]):
+    ## compare the matching kmers count of the top two rows
+    kmersCount = dfSort['KmersCount']
+    if len(kmersCount) > 1 and kmersCount.iat[0] == kmersCount.iat[1]:
         bestGenus = "This was a tie, see the top 5 results below"
         bestSpecies = " "
         logging.info("The top two isolates have the same number of matching\
 kmers, indicating a tie... ")
         return bestGenus, bestSpecies
     else:
-        best = dfSort.head(1)
+        best = dfSort.iloc[0]
         bestGenus = best['Genus']
-        bestGenus = bestGenus.str.cat(sep='\n')
         bestSpecies = best['Species']
-        bestSpecies = bestSpecies.str.cat(sep='\n')
         logging.info("There was not a tie of kmers for the top two species...")
         return bestGenus, bestSpecies
 
@@ -429,33 +741,32 @@ def noResult(inFile, inMaxDis, bestG, bestS):
     ----------
     inFile : pandas core frame data frame
         Parsed results from running mash
-    inDist : int
+    inMaxDis : float
         User specified maximum mash distance as a cut-off
 
     Returns
     ----------
         Message to log file and replacement of best species with message
     """
-    inMaxDis = float(inMaxDis)
     logging.info("Confirming that best match is less than user specfied distance...")
 
-    if (inFile['Mash Dist'].values[0] < inMaxDis):
+    if (inFile['Mash Dist'].iat[0] < inMaxDis):
         logging.info("Okay, a best species match was found with mash distance \
-less than %s..." % inMaxDis)
+less than %s...", inMaxDis)
     else:
         bestG = "No matches found with mash distances < %s..." % inMaxDis
         bestS = " "
-        logging.info("No matches found with mash distances < %s..." % inMaxDis)
+        logging.info("No matches found with mash distances < %s...", inMaxDis)
     return bestG, bestS
 
-def parseResults(cmd, inMaxDis):
+def parseResults(df, inMaxDis):
     """
-    run initial command and parse the results from mash
+    parse the results from mash
 
     Parameters
     ----------
-    cmd : list
-        Initial command to run for either fasta or fastq
+    df : pandas data frame
+        mash dist output from run_mash_dist
     inMaxDis : XXX
         XXX
 
@@ -465,37 +776,31 @@ def parseResults(cmd, inMaxDis):
         The most likely genus of the isolate tested
     bestSpecies
         The most likely species of the isolate tested
-    dfTop
-        The top five results from sorting Mash output
+    topHits
+        The top five results from sorting Mash output as tuples in
+        REPORT_COLUMNS order
     """
 
-    ## convert with StringIO and added headers (for development)
-    df = pd.read_csv(StringIO(cmd.stdout), sep='\t',
-    names=['Ref ID', 'Query ID', 'Mash Dist', 'P-value', 'Kmer'],
-    index_col=False)
-
-    dfGenus = df['Ref ID'].str.split('_', 1, expand=True)
-    tmpDF = pd.DataFrame(columns=['Genus', 'Species', 'GeneBank Identifier', '% Seq Sim'])
-    tmpDF['Genus'] = dfGenus[0]
+    ## no reference shared a kmer with the reads
+    if df.empty:
+        logging.info("No matches found with mash distances < %s...", inMaxDis)
+        return "No matches found with mash distances < %s..." % inMaxDis, " ", []
 
-    dfSpecies = dfGenus.iloc[:, -1].str.split('_', 1, expand=True)
-    tmpDF['Species'] = dfSpecies[0]
+    ## split the kmers for sorting because xx/xxxx; only the count is needed
+    df['KmersCount'] = df.Kmer.str.split("/", n=1).str[0].astype('int32')
 
-    dfGB = dfSpecies.iloc[:, -1].str.split('GCA', expand=True)
-    dfGB = 'GCA' + dfGB.iloc[:,-1]
-    tmpDF['GeneBank Identifier'] = dfGB
+    ## now get the top five species; the remaining columns are only built
+    ## for these rows
+    dfSorted = df.nlargest(5, 'KmersCount').copy()
 
-    df = df.join(tmpDF)
-
-    ## split the kmers for sorting because xx/xxxx
-    df[['KmersCount','sketchSize']] = df.Kmer.str.split("/", expand=True,)
-    df['KmersCount'] = df.KmersCount.astype(int)
+    ## one regex pass gets all three parts of the reference name
+    dfSorted[['Genus', 'Species', 'GeneBank Identifier']] = \
+    dfSorted['Ref ID'].str.extract(REF_ID_RE).fillna('')
 
     ## add column that is (1 - Mash Distance) * 100, which is % sequence similarity
-    df['% Seq Sim'] =  (1 - df['Mash Dist'])*100
+    dfSorted['% Seq Sim'] =  (1 - dfSorted['Mash Dist'])*100
 
-    ## now sort and get top species; test for a tie in kmerscount value
-    dfSorted = df.sort_values('KmersCount', ascending=False)
+    ## test for a tie in kmerscount value
     dfSortOut = isTie(dfSorted)
     bestGenusSort = dfSortOut[0]
     bestSpeciesSort = dfSortOut[1]
@@ -505,25 +810,15 @@ def parseResults(cmd, inMaxDis):
     #pd.options.display.float_format = '{:.7g}'.format
     #print("Line 500", dfSorted)
 
-    ## use column (axis = 1), to create minimal dataframe
-    dfSortedDropped = dfSorted.drop(['Ref ID', 'Query ID', 'KmersCount',
-    'sketchSize' ], axis=1)
-
     ## noResult function - confirm mash distance is < than user specified
     ## even if mash distance !< user specified, return the top five hits
-    noMash = noResult(dfSortedDropped, inMaxDis, bestGenusSort, bestSpeciesSort)
+    noMash = noResult(dfSorted, inMaxDis, bestGenusSort, bestSpeciesSort)
     bestGenus = noMash[0]
     bestSpecies = noMash[1]
 
-    # change order
-    dfSortedDropped = dfSortedDropped[['Genus', 'Species', 'GeneBank Identifier',
-    'Mash Dist', '% Seq Sim', 'P-value', 'Kmer']]
-    dfTop = dfSortedDropped[:5]
-
-##TO DO - scienfitic notation for P-value
-
-    dfTop.reset_index(drop=True, inplace=True) #make index start at 0
-    return bestGenus, bestSpecies, dfTop
+    ## plain tuples in report order are all makeTable needs
+    topHits = list(dfSorted[REPORT_COLUMNS].itertuples(index=False, name=None))
+    return bestGenus, bestSpecies, topHits
 
 def makeTable(dateTime, name, inRead1, inRead2, inMaxDist, results, mFlag):
     """
@@ -544,21 +839,34 @@ def makeTable(dateTime, name, inRead1, inRead2, inMaxDist, results, mFlag):
         text file with each isolates results appended that were run through
     """
 
-    with open(f"{name}_results_{dateString}.txt" ,'a+') as f:
-        f.writelines("\n" + "Legionella Species ID Tool using Mash" + "\n")
-        f.writelines("Date and Time = " + dtString + "\n") #+str(variable)
-        f.write("Input query file 1: " + inRead1 + "\n")
-        f.write("Input query file 2: " + inRead2 + "\n")
-        f.write("Genome size estimate for fastq files: " + mFlag[1] + " " +"(bp)" +"\n") #make into variable
-        f.write("Genome coverage estimate for fastq files: " + mFlag[2]  + "\n") #make into variables
-        f.write("Maximum mash distance (-d): " + str(inMaxDis) + "\n")
-        f.write("Minimum K-mer copy number (-m) to be included in the sketch: " + str(mFlag[0]) + "\n" )
-        f.write("K-mer size used for sketching: " + inKSize + "\n" )
-        f.write("Mash Database name: " + inMash + "\n" + "\n")
-        f.write("Best species match: " + results[0] + " " + results[1] + "\n" + "\n")
-        f.write("Top 5 hits:" + "\n")
-        f.writelines(u'\u2500' * 100 + "\n")
-        f.writelines(tabulate(results[2], headers='keys', tablefmt='pqsl', numalign="center", stralign="center", floatfmt=".4f")+ "\n")
+    ## with --dedup mash only sees the unique sequences, so the coverage is
+    ## not the coverage of the reads
+    if inDedup:
+        coverageLabel = "Genome coverage estimate for deduplicated reads \
+(unique sequences only): "
+    else:
+        coverageLabel = "Genome coverage estimate for fastq files: "
+
+    ## build the whole entry first and write it with a single call
+    parts = [
+        "\n" + "Legionella Species ID Tool using Mash" + "\n",
+        "Date and Time = " + dateTime + "\n",
+        "Input query file 1: " + inRead1 + "\n",
+        "Input query file 2: " + inRead2 + "\n",
+        "Genome size estimate for fastq files: " + mFlag[1] + " " + "(bp)" + "\n",
+        coverageLabel + mFlag[2] + "\n",
+        "Maximum mash distance (-d): " + str(inMaxDist) + "\n",
+        "Minimum K-mer copy number (-m) to be included in the sketch: " + str(mFlag[0]) + "\n",
+        "K-mer size used for sketching: " + inKSize + "\n",
+        "Mash Database name: " + inMash + "\n" + "\n",
+        "Best species match: " + str(results[0]) + " " + str(results[1]) + "\n" + "\n",
+        "Top 5 hits:" + "\n",
+        u'\u2500' * 100 + "\n",
+        REPORT_HEADER_FMT.format(*REPORT_COLUMNS) + "\n"]
+    parts += [REPORT_ROW_FMT.format(*row) + "\n" for row in results[2]]
+
+    with open(f"{name}_results_{dateString}.txt", 'a+', buffering=1<<16) as f:
+        f.writelines(parts)
 
 if __name__ == '__main__':
     ## parser is created from the function argparser
@@ -572,6 +880,7 @@ inKmer = args.kmer_min
 inThreads = args.num_threads
 inRead1 = args.read1
 inRead2 = args.read2
+inDedup = args.dedup
 
 now = datetime.now()
 dtString = now.strftime("%B %d, %Y %H:%M:%S")
@@ -581,31 +890,43 @@ dateString = now.strftime("%Y-%m-%d")
 name = fastq_name(inRead1)
 log = name + "_run"  + ".log"
 
-req_programs=['mash', 'python']
+req_programs=['mash']
 
 make_output_log(log)
-get_input(inRead1, inRead2, inMash, inMaxDis, inKmer, inKSize, inThreads)
 
-logging.info("Checking if all the required input files exist...")
-check_files(inRead1, inRead2, inMash)
+check_python()
+
+## the checks are independent so run them at the same time; a failed check
+## exits through result()
+logging.info("Checking if all the required input files exist and the \
+prerequisite programs are installed...")
+with ThreadPoolExecutor(max_workers=len(req_programs) + 1) as executor:
+    checks = [executor.submit(check_files, inRead1, inRead2, inMash)]
+    checks += [executor.submit(check_program, program) for program in req_programs]
+    for check in checks:
+        check.result()
+mashStat = checks[0].result()
 logging.info("Input files are present...")
-
-logging.info("Checking if all the prerequisite programs are installed...")
-for program in req_programs:
-    check_program(program)
 logging.info("All prerequisite programs are accessible...")
 
-logging.info("Begin concatenation of the fastq files...")
-cat_files(inRead1, inRead2)
-logging.info("Great, I was able to concatenate the files...")
+inKSize = get_k_size(inMash, mashStat, args.db_info)
+get_input(inRead1, inRead2, inMash, inMaxDis, inKmer, inKSize, inThreads)
 
-logging.info("Calculating estimated genome size and coverage...")
-mFlag = cal_kmer()
-logging.info("Minimum copies of each kmer required to pass noise filter \
+if inDedup:
+    ## unique reads carry no copy number, so there is nothing to filter and
+    ## the single -m 1 run also gives the genome size and coverage
+    logging.info("Reads were deduplicated, using 1 for minimum kmer...")
+    logging.info("Running Mash Dist command with -m flag...")
+    outputFastq2, stderr = get_results(1, inThreads)
+    mFlag = (1,) + get_SC(stderr)
+else:
+    logging.info("Calculating estimated genome size and coverage...")
+    mFlag = cal_kmer()
+    logging.info("Minimum copies of each kmer required to pass noise filter \
 identified ...")
 
-logging.info("Running Mash Dist command with -m flag...")
-outputFastq2 = get_results(mFlag[0], inThreads)
+    logging.info("Running Mash Dist command with -m flag...")
+    outputFastq2, stderr = get_results(mFlag[0], inThreads)
 logging.info("Completed running mash dist command...")
 
 logging.info("Beginning to parse the output results from mash dist...")
@@ -614,4 +935,4 @@ logging.info("Okay, completed parsing of the results...")
 
 logging.info("Generating table of results as a text file...")
 makeTable(dtString, name, inRead1, inRead2, inMaxDis, results, mFlag)
-logging.info("Completed analysis for the sample: %s..." % name )
+logging.info("Completed analysis for the sample: %s...", name)
@@ -21,22 +21,13 @@ process SPECIES_ID {
 
       script:
       """
-      kSize=\$(mash info  ${inDatabase} | awk 'FNR == 3 {print \$3}')
-      export kSize
-
-      ## converts .fastq.gz file to .fastq
-      gunzip -f "${reads[0]}"
-      gunzip -f "${reads[1]}"
-
-      ## stores in variable so we can strip off .gz in the command below
-      readsIn0="${reads[0]}"
-      readsIn1="${reads[1]}"
-
-      ${projectDir}/bin/run_species_id.py -b ${inDatabase} -r1 "\${readsIn0%.gz}"  -r2 "\${readsIn1%.gz}" -d ${params.max_dist} -m ${params.kmer_min} -p ${params.num_threads}
-
       echo $inDatabase >  "database.info"
       mash info $inDatabase >> "database.info"
 
+      ## gzipped reads are decompressed by the script as they are read; the
+      ## kmer size is taken from database.info
+      ${projectDir}/bin/run_species_id.py -b ${inDatabase} -r1 "${reads[0]}"  -r2 "${reads[1]}" -d ${params.max_dist} -m ${params.kmer_min} -p ${params.num_threads} ${params.dedup ? '--dedup' : ''} --db_info database.info
+
       cat <<-END_VERSIONS > versions.yml
       "${task.process}":
           python: \$(python --version | sed 's/Python //g')